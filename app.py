@@ -1,7 +1,7 @@
 import streamlit as st
 from datetime import datetime
 from models.persona import PersonaManager
-from chat.interface import ChatInterface
+from chat.interface import ChatInterface, avatar_data_url
 import logging
 
 # Configure the Streamlit page - must be first
@@ -11,6 +11,14 @@ st.set_page_config(page_title="AI Persona Lab", layout="wide", page_icon="🤖",
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
 
+# Occupations offered by the sidebar persona generator
+OCCUPATIONS = (
+    "Professor 👨‍🏫", "Engineer 👷", "Artist 🎨",
+    "Doctor 👨‍⚕️", "Writer ✍️", "Chef 👨‍🍳", "Other"
+)
+# Persona cards per dashboard row
+DASHBOARD_COLUMNS = 3
+
 def initialize_session_state():
     """Initialize session state with default values."""
     if 'persona_manager' not in st.session_state:
@@ -101,8 +109,7 @@ def render_persona_edit_dialog(persona):
         
         # --- Skills ---
         st.header("Skills")
-        skills_str = ", ".join(persona.skills)
-        new_skills = st.text_area("Skills (comma-separated)", value=skills_str, height=100)
+        new_skills = st.text_area("Skills (comma-separated)", value=persona.skills_str, height=100)
         
         # --- Persona-Specific Model Settings ---
         st.header("Persona Model Settings")
@@ -147,15 +154,51 @@ def render_persona_edit_dialog(persona):
             persona.notes = new_notes
             persona.tags = [t.strip() for t in new_tags.split(",") if t.strip()]
             persona.modified_at = datetime.now()
+            persona.invalidate_cache()
             
-            # Save all personas (as the original app.py did)
-            st.session_state.persona_manager._save_personas()
+            # Save all personas in the background so the dialog closes immediately
+            st.session_state.persona_manager.schedule_save()
             
             # Close the dialog
             del st.session_state.edit_persona_id
             st.success(f"Updated {persona.name}!")
             st.rerun()
 
+@st.fragment
+def render_dashboard():
+    """Render the persona cards; card buttons rerun only this fragment."""
+    cols = st.columns(DASHBOARD_COLUMNS)
+    
+    columns = st.session_state.persona_manager.list_personas_columnar()
+    cards = zip(
+        columns.ids, columns.names, columns.avatars, columns.models,
+        columns.occupations, columns.edit_keys, columns.delete_keys
+    )
+    for idx, (persona_id, name, avatar, model, occupation, edit_key, delete_key) in enumerate(cards):
+        col = cols[idx % DASHBOARD_COLUMNS] # Distribute personas across the columns
+        with col:
+            with st.container(border=True):
+                c1, c2 = st.columns([1, 2])
+                with c1:
+                    st.image(avatar_data_url(avatar), width=70)
+                with c2:
+                    st.subheader(name)
+                    st.caption(f"*{occupation}*")
+                
+                st.markdown(f"**Model:** `{model}`")
+                
+                if st.button("Edit ✏️", key=edit_key, use_container_width=True):
+                    # Set a session state flag to open the dialog
+                    st.session_state.edit_persona_id = persona_id
+                    # The dialog is opened by main(), so rerun the whole app
+                    st.rerun()
+                
+                # Add a delete button
+                if st.button("Delete 🗑️", key=delete_key, use_container_width=True):
+                    st.session_state.persona_manager.remove_persona(persona_id)
+                    st.success(f"Removed {name}")
+                    st.rerun()
+
 def main():
     # Initialize session state
     initialize_session_state()
@@ -169,11 +212,7 @@ def main():
     # Sidebar for creating new personas
     with st.sidebar:
         st.title("Persona Generator")
-        occupations = [
-            "Professor 👨‍🏫", "Engineer 👷", "Artist 🎨",
-            "Doctor 👨‍⚕️", "Writer ✍️", "Chef 👨‍🍳", "Other"
-        ]
-        selected_occupation = st.selectbox("Select Occupation", occupations)
+        selected_occupation = st.selectbox("Select Occupation", OCCUPATIONS)
         
         if selected_occupation == "Other":
             custom_occupation = st.text_input("Enter Custom Occupation")
@@ -199,32 +238,8 @@ def main():
         st.info("Add some personas using the sidebar to start!")
         return
 
-    num_cols = 3 # 3 cards per row
-    cols = st.columns(num_cols)
+    render_dashboard()
     
-    for idx, persona in enumerate(personas):
-        col = cols[idx % num_cols] # Distribute personas into 3 columns
-        with col:
-            with st.container(border=True):
-                c1, c2 = st.columns([1, 2])
-                with c1:
-                    st.image(persona.avatar, width=70)
-                with c2:
-                    st.subheader(persona.name)
-                    st.caption(f"*{persona.occupation}*")
-                
-                st.markdown(f"**Model:** `{persona.model}`")
-                
-                if st.button("Edit ✏️", key=f"edit_{persona.id}", use_container_width=True):
-                    # Set a session state flag to open the dialog
-                    st.session_state.edit_persona_id = persona.id
-                
-                # Add a delete button
-                if st.button("Delete 🗑️", key=f"delete_{persona.id}", use_container_width=True):
-                    st.session_state.persona_manager.remove_persona(persona.id)
-                    st.success(f"Removed {persona.name}")
-                    st.rerun()
-                    
 # --- DIALOG HANDLING ---
     # Check if the edit flag is set in session state
     if 'edit_persona_id' in st.session_state:
@@ -0,0 +1,183 @@
+import os
+import logging
+import httpx
+import orjson
+from models.persona import Persona
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_BASE_URL = "http://127.0.0.1:11434"
+OLLAMA_KEEP_ALIVE = "30m"
+# Match client concurrency to the number of requests Ollama actually serves at once
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+
+# OpenAI-compatible vLLM server; it batches concurrent requests itself
+VLLM_URL = os.getenv("VLLM_URL", "http://127.0.0.1:8000")
+# Served model name; defaults to each persona's own model
+VLLM_MODEL = os.getenv("VLLM_MODEL")
+VLLM_MAX_PARALLEL = int(os.getenv("VLLM_MAX_PARALLEL", "32"))
+
+# Request bodies are serialized with orjson and sent as raw content
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Identical for every persona and placed first in the system prompt so the
+# server can reuse the prefilled KV cache across personas and turns.
+SHARED_PREFIX = """You are taking part in a group chat between a user and several characters.
+Respond to messages in character, incorporating your background, personality, and expertise.
+Keep responses concise (2-3 sentences) and natural.
+"""
+# Rough token count of SHARED_PREFIX (~4 characters per token)
+SHARED_PREFIX_NUM_KEEP = len(SHARED_PREFIX) // 4
+
+def _persona_prompt(persona: Persona, prompt: str) -> str:
+    return f"Previous message: {prompt}\nRespond naturally as {persona.name}:"
+
+def _assistant_message(persona: Persona, content: str) -> dict:
+    return {
+        "role": "assistant",
+        "content": content,
+        "name": persona.name,
+        "avatar": persona.avatar
+    }
+
+def _payload_skeleton(persona: Persona) -> dict:
+    """Return the persona's cached /api/generate payload; callers only set "prompt"."""
+    if persona._payload_skeleton is None:
+        persona._payload_skeleton = {
+            "model": persona.model,
+            "system": SHARED_PREFIX + persona.system_prompt,
+            "stream": True,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "options": {
+                "temperature": persona.temperature,
+                "num_predict": persona.max_tokens,
+                "num_keep": SHARED_PREFIX_NUM_KEEP
+            }
+        }
+    return persona._payload_skeleton
+
+class OllamaBackend:
+    """Local Ollama server (/api/generate)."""
+    base_url = OLLAMA_BASE_URL
+    max_parallel = OLLAMA_NUM_PARALLEL
+
+    async def generate(self, client: httpx.AsyncClient, persona: Persona, prompt: str, placeholder=None) -> dict:
+        """Stream a persona's reply into `placeholder` and return the message dictionary."""
+        payload = _payload_skeleton(persona)
+        payload["prompt"] = _persona_prompt(persona, prompt)
+        # Serialize now, before any await, while the shared skeleton holds this prompt
+        body = orjson.dumps(payload)
+
+        accum = ""
+        async with client.stream("POST", "/api/generate", content=body, headers=JSON_HEADERS) as response:
+            response.raise_for_status()
+            # Ollama streams one JSON object per line
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                accum += chunk.get("response", "")
+                if placeholder is not None:
+                    placeholder.info(accum)
+        return _assistant_message(persona, accum.strip())
+
+    async def generate_group(self, client: httpx.AsyncClient, personas: list, prompt: str) -> dict:
+        """
+        Answer as several personas sharing one model in a single JSON-mode call.
+        Returns a {persona name: reply} dictionary.
+        """
+        # Full persona prompts, so batched replies keep background and routine
+        persona_blurbs = [f"Character: {p.name}\n{p.system_prompt}" for p in personas]
+        group_prompt = (
+            "You will roleplay as each of the characters below. Return STRICT JSON: "
+            "{\"responses\":[{\"name\":..., \"content\":...}]} with one entry per character, "
+            "using the character's name exactly as given.\n\n"
+            + "\n".join(persona_blurbs) + f"\nUser said: {prompt}"
+        )
+        response = await client.post(
+            "/api/generate",
+            content=orjson.dumps({
+                "model": personas[0].model,
+                "system": SHARED_PREFIX,
+                "prompt": group_prompt,
+                "format": "json",
+                "stream": False,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
+                "options": {
+                    "temperature": personas[0].temperature,
+                    "num_predict": personas[0].max_tokens * len(personas)
+                }
+            }),
+            headers=JSON_HEADERS
+        )
+        response.raise_for_status()
+        result = orjson.loads(response.content)
+        return {
+            r["name"]: r["content"].strip()
+            for r in orjson.loads(result["response"])["responses"]
+        }
+
+    async def warm(self, client: httpx.AsyncClient, persona: Persona):
+        """Ask Ollama to load the persona's model so the next chat turn skips the load time."""
+        try:
+            response = await client.post(
+                "/api/generate",
+                content=orjson.dumps({
+                    "model": persona.model,
+                    "prompt": "",
+                    "keep_alive": OLLAMA_KEEP_ALIVE,
+                    "options": {"num_predict": 1}
+                }),
+                headers=JSON_HEADERS
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning("Error warming model %s: %s", persona.model, e)
+
+class VLLMBackend:
+    """vLLM OpenAI-compatible server (/v1/completions) with continuous batching."""
+    base_url = VLLM_URL
+    max_parallel = VLLM_MAX_PARALLEL
+    # No generate_group(): concurrent requests already decode together on the server
+
+    async def generate(self, client: httpx.AsyncClient, persona: Persona, prompt: str, placeholder=None) -> dict:
+        """Stream a persona's reply into `placeholder` and return the message dictionary."""
+        body = orjson.dumps({
+            "model": VLLM_MODEL or persona.model,
+            "prompt": SHARED_PREFIX + persona.system_prompt + "\n" + _persona_prompt(persona, prompt),
+            "temperature": persona.temperature,
+            "max_tokens": persona.max_tokens,
+            "stream": True
+        })
+
+        accum = ""
+        async with client.stream("POST", "/v1/completions", content=body, headers=JSON_HEADERS) as response:
+            response.raise_for_status()
+            # Server-sent events: "data: {...}" lines, terminated by "data: [DONE]"
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = orjson.loads(data)
+                accum += chunk["choices"][0].get("text", "")
+                if placeholder is not None:
+                    placeholder.info(accum)
+        return _assistant_message(persona, accum.strip())
+
+    async def warm(self, client: httpx.AsyncClient, persona: Persona):
+        # vLLM keeps its model loaded for the lifetime of the server
+        pass
+
+BACKENDS = {
+    "ollama": OllamaBackend,
+    "vllm": VLLMBackend
+}
+
+def get_backend(name: str):
+    """Return a backend instance by name (see BACKENDS)."""
+    try:
+        return BACKENDS[name.lower()]()
+    except KeyError:
+        raise ValueError(f"Unknown LLM backend: {name}")
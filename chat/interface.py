@@ -1,67 +1,290 @@
 import streamlit as st
 import httpx  # <-- New: Async-compatible requests
 import asyncio # <-- New: For running async tasks
+import base64
+import orjson
+import mimetypes
+import os
+import atexit
+import logging
+import queue
+import uuid
+import threading
+from collections import deque
+from datetime import datetime
 from models.persona import Persona # Ensure Persona is imported if needed
+from chat.backends import get_backend
+
+logger = logging.getLogger(__name__)
+
+# Messages kept in the session; older ones are spilled to CHAT_LOG_PATH,
+# tagged with the session id so histories from concurrent sessions stay separable
+MAX_MESSAGES = 200
+CHAT_LOG_PATH = "data/chat_log.jsonl"
+# Wall-clock budget (seconds) for all personas to answer one message
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", "120"))
+# Opt-in: answer personas that share a model in one JSON-mode call (no token streaming)
+BATCH_PERSONAS = os.getenv("BATCH_PERSONAS", "0") == "1"
+
+@st.cache_resource(show_spinner=False)
+def _load_avatar_data_url(path: str) -> str:
+    """Read a local avatar file once and return it as a data: URL."""
+    with open(path, "rb") as f:
+        data = f.read()
+    mime = mimetypes.guess_type(path)[0] or "image/png"
+    return f"data:{mime};base64," + base64.b64encode(data).decode()
+
+def avatar_data_url(avatar: str) -> str:
+    """Return a cached data: URL for a local avatar file; remote URLs are left to the browser."""
+    if avatar.startswith(("http://", "https://")):
+        return avatar
+    try:
+        return _load_avatar_data_url(avatar)
+    except OSError:
+        return avatar
+
+async def _create_httpx_client(base_url: str) -> httpx.AsyncClient:
+    """Create the pooled client from inside the loop it will be used on."""
+    return httpx.AsyncClient(
+        base_url=base_url,
+        http2=True,
+        # No read timeout: long generations are bounded by CHAT_DEADLINE instead
+        timeout=httpx.Timeout(connect=2.0, read=None, write=5.0, pool=2.0),
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=32)
+    )
+
+@st.cache_resource(show_spinner=False)
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """Process-wide event loop on a daemon thread, so we don't pay for asyncio.run() per message."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True, name="chat-event-loop").start()
+    return loop
+
+@st.cache_resource(show_spinner=False)
+def _shared_client(base_url: str) -> httpx.AsyncClient:
+    """Process-wide pooled client, created on (and bound to) the background loop."""
+    loop = _background_loop()
+    client = asyncio.run_coroutine_threadsafe(_create_httpx_client(base_url), loop).result()
+    atexit.register(lambda: asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout=5))
+    return client
+
+async def _create_semaphore(limit: int) -> asyncio.Semaphore:
+    """Create the semaphore from inside the loop it will be used on (needed before Python 3.10)."""
+    return asyncio.Semaphore(limit)
+
+@st.cache_resource(show_spinner=False)
+def _shared_semaphore(limit: int) -> asyncio.Semaphore:
+    """Limits in-flight requests across all sessions."""
+    return asyncio.run_coroutine_threadsafe(_create_semaphore(limit), _background_loop()).result()
+
+class _PlaceholderProxy:
+    """
+    Stand-in for an st.empty() placeholder that can be written from the loop thread.
+    Updates are queued and rendered by the script thread in _run_in_background.
+    """
+    def __init__(self, placeholder, updates: queue.Queue):
+        self._placeholder = placeholder
+        self._updates = updates
+
+    def info(self, text: str):
+        self._updates.put((self._placeholder, text))
 
 class ChatInterface:
     def __init__(self):
+        if 'chat_session_id' not in st.session_state:
+            st.session_state.chat_session_id = str(uuid.uuid4())
         if 'messages' not in st.session_state:
-            st.session_state.messages = []
-        if 'active_personas' not in st.session_state:
-            st.session_state.active_personas = set()
+            st.session_state.messages = deque(maxlen=MAX_MESSAGES)
+        elif not isinstance(st.session_state.messages, deque) or st.session_state.messages.maxlen != MAX_MESSAGES:
+            # Older sessions (or a hot reload) may still hold a plain list
+            history = list(st.session_state.messages)
+            st.session_state.messages = deque(maxlen=MAX_MESSAGES)
+            self._add_messages(history)
         if 'persona_active_states' not in st.session_state:
             st.session_state.persona_active_states = {}
+        # Ollama by default; LLM_BACKEND=vllm targets an OpenAI-compatible vLLM server
+        self._backend = get_backend(os.environ.get("LLM_BACKEND", "ollama"))
+        self._client = _shared_client(self._backend.base_url)
+        self._semaphore = _shared_semaphore(self._backend.max_parallel)
+
+    def _spill_messages(self, records: list):
+        """Append messages dropped from the session history to the on-disk chat log."""
+        session_id = st.session_state.chat_session_id
+        os.makedirs(os.path.dirname(CHAT_LOG_PATH), exist_ok=True)
+        with open(CHAT_LOG_PATH, "ab") as f:
+            for record in records:
+                f.write(orjson.dumps({"session_id": session_id, **record}) + b"\n")
+
+    def _add_messages(self, new_messages: list):
+        """Append messages to the bounded session history, spilling whatever no longer fits."""
+        now = datetime.now()
+        for message in new_messages:
+            message.setdefault("timestamp", now)
+        messages = st.session_state.messages
+        overflow = len(messages) + len(new_messages) - messages.maxlen
+        if overflow > 0:
+            spilled = [messages.popleft() for _ in range(min(overflow, len(messages)))]
+            # A batch larger than the history also loses its own leading messages on extend
+            spilled.extend(new_messages[:overflow - len(spilled)])
+            self._spill_messages(spilled)
+        messages.extend(new_messages)
 
-    async def _get_persona_response_async(self, session: httpx.AsyncClient, persona: Persona, prompt: str) -> dict:
+    def _run_in_background(self, coro, updates: queue.Queue):
         """
-        Get a response from a persona using Ollama API (ASYNC).
-        Returns a message dictionary.
+        Run a coroutine on the background loop and wait for the result,
+        rendering the placeholder updates it queues along the way.
         """
-        system_prompt = f"""You are {persona.name}, a {persona.age}-year-old {persona.nationality} {persona.occupation}.
-        Background: {persona.background}
-        Daily Routine: {persona.routine}
-        Personality: {persona.personality}
-        Skills: {', '.join(persona.skills)}
-        
-        Respond to messages in character, incorporating your background, personality, and expertise.
-        Keep responses concise (2-3 sentences) and natural.
+        future = asyncio.run_coroutine_threadsafe(coro, _background_loop())
+        while True:
+            finished = future.done()
+            # Only the newest text per placeholder needs to be drawn
+            latest = {}
+            try:
+                placeholder, text = updates.get(timeout=0.05)
+                latest[placeholder] = text
+                while True:
+                    placeholder, text = updates.get_nowait()
+                    latest[placeholder] = text
+            except queue.Empty:
+                pass
+            for placeholder, text in latest.items():
+                placeholder.info(text)
+            if finished:
+                return future.result()
+
+    async def _get_persona_response_async(self, persona: Persona, prompt: str, placeholder=None) -> dict:
+        """
+        Get a response from a persona using the configured backend (ASYNC).
+        Tokens are streamed into `placeholder` as they arrive.
+        Returns a message dictionary.
         """
-        
         try:
-            response = await session.post(
-                "http://127.0.0.1:11434/api/generate",
-                json={
-                    "model": persona.model,
-                    "prompt": f"Previous message: {prompt}\nRespond naturally as {persona.name}:",
-                    "system": system_prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": persona.temperature,
-                        "num_predict": persona.max_tokens
-                    }
-                },
-                timeout=30.0 # Add a timeout
-            )
-            response.raise_for_status()
-            result = response.json()
-            
-            # Return the message dictionary
+            async with self._semaphore:
+                return await self._backend.generate(self._client, persona, prompt, placeholder)
+        except Exception as e:
+            logger.exception("Error getting response from %s", persona.name)
+            # Return an error message in the bot's "voice"
             return {
                 "role": "assistant",
-                "content": result["response"].strip(),
+                "content": f"Sorry, I'm having trouble responding right now. (Error: {str(e)})",
                 "name": persona.name,
                 "avatar": persona.avatar
             }
-            
+
+    async def _get_group_responses_async(self, members: list, prompt: str) -> list:
+        """
+        Get responses for several personas that share a model in one backend call.
+        `members` is a list of (persona, placeholder) pairs.
+        Falls back to one request per persona if the model's JSON can't be used.
+        Returns a list of message dictionaries.
+        """
+        if len(members) == 1:
+            persona, placeholder = members[0]
+            return [await self._get_persona_response_async(persona, prompt, placeholder)]
+        
+        personas = [persona for persona, _ in members]
+        try:
+            async with self._semaphore:
+                replies = await self._backend.generate_group(self._client, personas, prompt)
         except Exception as e:
-            print(f"Error getting response from {persona.name}: {str(e)}")
-            # Return an error message in the bot's "voice"
-            return {
+            logger.warning("Batched response failed, falling back to per-persona requests: %s", e)
+            replies = {}
+        
+        messages = []
+        fallback = []
+        for persona, placeholder in members:
+            content = replies.get(persona.name)
+            if not content:
+                fallback.append(self._get_persona_response_async(persona, prompt, placeholder))
+                continue
+            placeholder.info(content)
+            messages.append({
                 "role": "assistant",
-                "content": f"Sorry, I'm having trouble responding right now. (Error: {str(e)})",
+                "content": content,
                 "name": persona.name,
                 "avatar": persona.avatar
-            }
+            })
+        messages.extend(await asyncio.gather(*fallback))
+        return messages
+
+    async def _get_all_responses_async(self, personas: list, placeholders: list, prompt: str, results: list):
+        """
+        Gathers all persona responses concurrently into `results`.
+        Runs on the background loop, so it must not touch st.session_state.
+        """
+        # With BATCH_PERSONAS, personas sharing the same model settings are answered in a
+        # single call when the backend can batch (has generate_group); otherwise each
+        # persona is its own group and streams its reply
+        batching = BATCH_PERSONAS and hasattr(self._backend, "generate_group")
+        groups = {}
+        for persona, placeholder in zip(personas, placeholders):
+            if batching:
+                key = (persona.model, persona.temperature, persona.max_tokens)
+            else:
+                key = persona.id
+            groups.setdefault(key, []).append((persona, placeholder))
+        if not groups:
+            # Every persona is toggled off; asyncio.wait() rejects an empty set
+            return
+        
+        tasks = {}
+        for members in groups.values():
+            task = asyncio.ensure_future(self._get_group_responses_async(members, prompt))
+            tasks[task] = members
+        
+        done, pending = await asyncio.wait(tasks, timeout=CHAT_DEADLINE)
+        for task in pending:
+            task.cancel()
+        
+        # Add valid responses to the message list
+        for task, members in tasks.items():
+            if task in done:
+                results.extend([res for res in task.result() if res])
+                continue
+            for persona, _ in members:
+                results.append({
+                    "role": "assistant",
+                    "content": f"Sorry, I ran out of time to respond. (No reply within {CHAT_DEADLINE:.0f}s)",
+                    "name": persona.name,
+                    "avatar": persona.avatar
+                })
+
+    @st.fragment
+    def _active_personas_panel(self, personas):
+        """Persona toggles; flipping one reruns only this fragment."""
+        for persona in personas:
+            col1, col2 = st.columns([1, 3])
+            with col1:
+                st.image(avatar_data_url(persona.avatar), width=50)
+            with col2:
+                st.write(f"**{persona.name}**")
+            
+            was_active = st.session_state.persona_active_states.get(persona.id, True)
+            is_active = st.toggle("Active in Chat", value=was_active, key=f"toggle_{persona.id}")
+            st.session_state.persona_active_states[persona.id] = is_active
+            if is_active and not was_active:
+                # Fire-and-forget: load the model while the user is still typing
+                asyncio.run_coroutine_threadsafe(
+                    self._backend.warm(self._client, persona),
+                    _background_loop()
+                )
+            st.divider()
+
+    @st.fragment
+    def _chat_log(self):
+        """Display chat messages (NEW UI)."""
+        for message in st.session_state.messages:
+            if message["role"] == "user":
+                with st.chat_message("user", avatar="👤"):
+                    st.write(f"**You:** {message['content']}")
+            else:
+                # Bot-centric UI
+                col1, col2 = st.columns([1, 10]) 
+                with col1:
+                    st.image(avatar_data_url(message["avatar"]), width=50, caption=message.get("name"))
+                with col2:
+                    # Using st.info() for the bot-theme bubble
+                    st.info(message["content"])
 
     def render(self):
         """Render the chat interface."""
@@ -89,65 +312,42 @@ class ChatInterface:
             # Current Personas section (toggles)
             st.subheader("Active Personas (Chat)")
             personas = st.session_state.persona_manager.list_personas()
-            for persona in personas:
-                col1, col2 = st.columns([1, 3])
-                with col1:
-                    st.image(persona.avatar, width=50)
-                with col2:
-                    st.write(f"**{persona.name}**")
-                
-                is_active = st.session_state.persona_active_states.get(persona.id, True)
-                if st.toggle("Active in Chat", value=is_active, key=f"toggle_{persona.id}"):
-                    st.session_state.active_personas.add(persona.id)
-                    st.session_state.persona_active_states[persona.id] = True
-                else:
-                    st.session_state.active_personas.discard(persona.id)
-                    st.session_state.persona_active_states[persona.id] = False
-                st.divider()
+            self._active_personas_panel(personas)
         
         # --- Main chat area ---
         st.subheader("🤖 Group Chat")
-        
-        # --- Display chat messages (NEW UI) ---
-        for message in st.session_state.messages:
-            if message["role"] == "user":
-                with st.chat_message("user", avatar="👤"):
-                    st.write(f"**You:** {message['content']}")
-            else:
-                # Bot-centric UI
-                col1, col2 = st.columns([1, 10]) 
-                with col1:
-                    st.image(message["avatar"], width=50, caption=message.get("name"))
-                with col2:
-                    # Using st.info() for the bot-theme bubble
-                    st.info(message["content"])
+        self._chat_log()
 
         # --- Chat input (NEW ASYNC LOGIC) ---
         if prompt := st.chat_input("Chat with your active personas..."):
             # Add user message
-            st.session_state.messages.append({
+            self._add_messages([{
                 "role": "user",
                 "content": prompt,
                 "name": "You"
-            })
+            }])
             
             # Get active personas
-            active_personas = [p for p in personas if p.id in st.session_state.active_personas]
+            active_states = st.session_state.persona_active_states
+            active_personas = [p for p in personas if active_states.get(p.id, True)]
             
-            async def get_all_responses():
-                """Gathers all persona responses concurrently."""
-                async with httpx.AsyncClient() as session:
-                    tasks = []
-                    for persona in active_personas:
-                        tasks.append(self._get_persona_response_async(session, persona, prompt))
-                    
-                    # Wait for all responses
-                    responses = await asyncio.gather(*tasks)
-                    # Add valid responses to the message list
-                    st.session_state.messages.extend([res for res in responses if res])
+            # One placeholder per persona so replies stream in side by side.
+            # The loop thread can't write to Streamlit, so it gets proxies.
+            updates = queue.Queue()
+            placeholders = []
+            for persona in active_personas:
+                col1, col2 = st.columns([1, 10])
+                with col1:
+                    st.image(avatar_data_url(persona.avatar), width=50, caption=persona.name)
+                with col2:
+                    placeholders.append(_PlaceholderProxy(st.empty(), updates))
             
-            # Run the async function
-            asyncio.run(get_all_responses())
+            # Run the async function and add its replies to the history
+            results = []
+            self._run_in_background(
+                self._get_all_responses_async(active_personas, placeholders, prompt, results), updates
+            )
+            self._add_messages(results)
             
             # Rerun to update the chat display
             st.rerun()
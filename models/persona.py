@@ -1,14 +1,37 @@
 from datetime import datetime
-from typing import List, Optional
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from collections import ChainMap
 import uuid
 import json
+import orjson
 import requests
 import os
-from pydantic import BaseModel
+import mmap
+import logging
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel, PrivateAttr
 
 OLLAMA_API_URL = "http://127.0.0.1:11434/api"
 # OLLAMA_API_URL = "http://localhost:11434/api"
 
+logger = logging.getLogger(__name__)
+
+PERSONAS_PATH = "data/personas.json"
+# Background saves wait this long so rapid edits collapse into one write
+SAVE_DEBOUNCE_SECONDS = 0.5
+
+# Persona-specific part of the chat system prompt, filled from the persona's fields
+SYSTEM_PROMPT_TEMPLATE = """You are {name}, a {age}-year-old {nationality} {occupation}.
+Background: {background}
+Daily Routine: {routine}
+Personality: {personality}
+Skills: {skills_str}
+"""
+
 class Persona(BaseModel):
     id: str
     name: str
@@ -28,6 +51,56 @@ class Persona(BaseModel):
     tags: List[str] = []
     notes: str = ""
 
+    # Derived strings, built lazily and cleared on edit
+    _system_prompt: Optional[str] = PrivateAttr(default=None)
+    _skills_str: str = PrivateAttr(default="")
+    # Static part of the chat request payload; filled in by the chat interface
+    _payload_skeleton: Optional[dict] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context):
+        self._skills_str = ", ".join(self.skills)
+
+    def __eq__(self, other):
+        # Compare fields only; the cached private attributes above must not affect equality
+        if not isinstance(other, Persona):
+            return NotImplemented
+        return self.__dict__ == other.__dict__
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name == "skills":
+            self._skills_str = ", ".join(value)
+
+    @property
+    def skills_str(self) -> str:
+        """Skills as a comma-separated string."""
+        return self._skills_str
+
+    @property
+    def system_prompt(self) -> str:
+        """Persona-specific part of the chat system prompt (cached)."""
+        if self._system_prompt is None:
+            self._system_prompt = SYSTEM_PROMPT_TEMPLATE.format_map(
+                ChainMap({"skills_str": self._skills_str}, self.__dict__)
+            )
+        return self._system_prompt
+
+    def invalidate_cache(self):
+        """Drop cached derived values after the persona has been edited."""
+        self._system_prompt = None
+        self._payload_skeleton = None
+
+@dataclass(frozen=True)
+class PersonaColumns:
+    """Column-wise (struct-of-arrays) snapshot of personas, used for rendering."""
+    ids: Tuple[str, ...]
+    names: Tuple[str, ...]
+    avatars: Tuple[str, ...]
+    models: Tuple[str, ...]
+    occupations: Tuple[str, ...]
+    edit_keys: Tuple[str, ...]
+    delete_keys: Tuple[str, ...]
+
 class PersonaManager:
     def __init__(self):
         self.personas = []
@@ -36,20 +109,57 @@ class PersonaManager:
             "default_temperature": 0.7,
             "default_max_tokens": 1000
         }
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._save_pending = threading.Event()
+        self._save_lock = threading.Lock()
         self._load_settings()
         self._load_personas()
     
     def _load_personas(self):
         try:
-            with open("data/personas.json", "r") as f:
-                data = json.load(f)
-                self.personas = [Persona(**p) for p in data]
+            with open(PERSONAS_PATH, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    # mmap can't map an empty file
+                    data = []
+                else:
+                    # Parse straight from the mapped pages instead of reading into a bytes copy
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                        data = orjson.loads(view)
+            self.personas = [Persona(**p) for p in data]
         except FileNotFoundError:
             self.personas = []
     
     def _save_personas(self):
-        with open("data/personas.json", "w") as f:
-            json.dump([p.dict() for p in self.personas], f, default=str)
+        """Write all personas atomically (temp file + rename)."""
+        with self._save_lock:
+            # Serialize under the lock so an older snapshot can never be written after a newer one
+            data = orjson.dumps([p.model_dump() for p in list(self.personas)])
+            os.makedirs(os.path.dirname(PERSONAS_PATH), exist_ok=True)
+            # Unique temp file: the lock only covers this manager, and every session has its own
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(PERSONAS_PATH), prefix="personas.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, PERSONAS_PATH)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+    
+    def schedule_save(self):
+        """Save personas on a background thread, coalescing rapid successive calls."""
+        self._save_pending.set()
+        self._save_executor.submit(self._debounced_save)
+    
+    def _debounced_save(self):
+        time.sleep(SAVE_DEBOUNCE_SECONDS)
+        if not self._save_pending.is_set():
+            # An earlier queued save already wrote these changes
+            return
+        self._save_pending.clear()
+        try:
+            self._save_personas()
+        except Exception:
+            logger.exception("Error saving personas")
     
     def _load_settings(self):
         """Load settings from settings.json"""
@@ -257,6 +367,19 @@ IMPORTANT:
         """Return list of all personas."""
         return self.personas
     
+    def list_personas_columnar(self) -> PersonaColumns:
+        """Return all personas as parallel tuples, with widget keys precomputed."""
+        ids = tuple(p.id for p in self.personas)
+        return PersonaColumns(
+            ids=ids,
+            names=tuple(p.name for p in self.personas),
+            avatars=tuple(p.avatar for p in self.personas),
+            models=tuple(p.model for p in self.personas),
+            occupations=tuple(p.occupation for p in self.personas),
+            edit_keys=tuple(f"edit_{i}" for i in ids),
+            delete_keys=tuple(f"delete_{i}" for i in ids)
+        )
+    
     def get_persona(self, persona_id: str) -> Optional[Persona]:
         """Get a specific persona by ID."""
         return next((p for p in self.personas if p.id == persona_id), None)